@@ -6,15 +6,17 @@ Usage:
     python batch_download.py --query "SELECT SeriesInstanceUID FROM index WHERE collection_id='nlst' LIMIT 100" --output ./data
     python batch_download.py --manifest manifest.csv --output ./data
     python batch_download.py --collection rider_pilot --output ./data
+    python batch_download.py --collection rider_pilot --output ./data --validate
 """
 
 import argparse
+import asyncio
+import contextlib
 import json
 import logging
 import shutil
 import sys
-import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 try:
@@ -32,17 +34,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upper bound on the exponential backoff between retries of a failed batch
+MAX_BACKOFF_SECONDS = 60
+
+# Attributes idc-index substitutes into the directory template
+TEMPLATE_ATTRIBUTES = ('PatientID', 'collection_id', 'Modality',
+                       'StudyInstanceUID', 'SeriesInstanceUID')
+
+# Per-process client for parallel downloads (see _init_download_worker)
+_worker_client = None
+
+
+def _init_download_worker():
+    """Create the IDCClient used by a download worker process."""
+    global _worker_client
+    _worker_client = IDCClient()
+
+
+def _download_batch(batch: list, download_dir: str, dir_template: str,
+                    client: IDCClient = None):
+    """Download one batch of series (blocking)."""
+    (client or _worker_client).download_from_selection(
+        seriesInstanceUID=batch,
+        downloadDir=download_dir,
+        dirTemplate=dir_template
+    )
+
 
 class BatchDownloader:
     """Memory-efficient batch downloader for IDC data."""
 
-    def __init__(self, output_dir: str, batch_size: int = 20,
-                 dir_template: str = "%collection_id/%PatientID/%Modality_%SeriesInstanceUID"):
+    DEFAULT_BATCH_SIZE = 100
+
+    def __init__(self, output_dir: str, batch_size: int | None = None,
+                 dir_template: str = "%collection_id/%PatientID/%Modality_%SeriesInstanceUID",
+                 max_workers: int = 1, max_retries: int = 3, validate: bool = False):
+        if validate and '%SeriesInstanceUID' not in dir_template:
+            raise ValueError("Validating downloads requires %SeriesInstanceUID in dir_template")
+
         self.client = IDCClient()
         self.output_dir = Path(output_dir)
-        self.batch_size = batch_size
+        self.batch_size = batch_size if batch_size is not None else self.DEFAULT_BATCH_SIZE
         self.dir_template = dir_template
-        self.progress_file = self.output_dir / ".download_progress.json"
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.validate = validate
+        # Append-only journal of downloaded series, one UID per line
+        self.progress_file = self.output_dir / ".download_progress.txt"
+        # JSON progress file written by earlier versions, still honored on resume
+        self.legacy_progress_file = self.output_dir / ".download_progress.json"
 
     def get_series_from_query(self, query: str) -> pd.DataFrame:
         """Execute SQL query and return series to download."""
@@ -53,7 +93,7 @@ class BatchDownloader:
             raise ValueError("Query must return SeriesInstanceUID column")
 
         logger.info(f"Query returned {len(results)} series")
-        return results
+        return self._add_series_sizes(results)
 
     def get_series_from_manifest(self, manifest_path: str) -> pd.DataFrame:
         """Load series from CSV manifest file."""
@@ -64,31 +104,28 @@ class BatchDownloader:
             raise ValueError("Manifest must contain SeriesInstanceUID column")
 
         logger.info(f"Manifest contains {len(df)} series")
-        return df
+        return self._add_series_sizes(df)
 
     def get_series_from_collection(self, collection_id: str) -> pd.DataFrame:
         """Get all series from a collection."""
-        query = f"""
-            SELECT SeriesInstanceUID, series_size_MB, instanceCount
-            FROM index
-            WHERE collection_id = '{collection_id}'
-        """
-        return self.get_series_from_query(query)
+        # Filter the client's index directly so collection_id never becomes
+        # part of an SQL string
+        index = self.client.index
+        series = index.loc[index['collection_id'] == collection_id,
+                           ['SeriesInstanceUID', 'series_size_MB', 'instanceCount']]
+        logger.info(f"Collection {collection_id} has {len(series)} series")
+        return series.reset_index(drop=True)
+
+    def _add_series_sizes(self, series_df: pd.DataFrame) -> pd.DataFrame:
+        """Add the series_size_MB column from the client's index if missing."""
+        if 'series_size_MB' in series_df.columns:
+            return series_df
+        sizes = self.client.index[['SeriesInstanceUID', 'series_size_MB']]
+        return series_df.merge(sizes, on='SeriesInstanceUID', how='left')
 
     def estimate_download_size(self, series_df: pd.DataFrame) -> dict:
         """Estimate total download size."""
-        if 'series_size_MB' in series_df.columns:
-            total_mb = series_df['series_size_MB'].sum()
-        else:
-            # Query for sizes if not in DataFrame
-            uids = "', '".join(series_df['SeriesInstanceUID'].values)
-            size_query = f"""
-                SELECT SUM(series_size_MB) as total_mb
-                FROM index
-                WHERE SeriesInstanceUID IN ('{uids}')
-            """
-            result = self.client.sql_query(size_query)
-            total_mb = result['total_mb'].iloc[0] if not result.empty else 0
+        total_mb = self._add_series_sizes(series_df)['series_size_MB'].sum()
 
         return {
             'series_count': len(series_df),
@@ -108,28 +145,85 @@ class BatchDownloader:
 
         return free_mb >= required_with_buffer
 
-    def load_progress(self) -> set:
+    def load_progress(self) -> frozenset:
         """Load previously downloaded series UIDs."""
+        completed = set()
+        if self.legacy_progress_file.exists():
+            with open(self.legacy_progress_file) as f:
+                completed.update(json.load(f).get('completed', []))
         if self.progress_file.exists():
+            # Stream the journal line by line instead of reading it whole
             with open(self.progress_file) as f:
-                data = json.load(f)
-                return set(data.get('completed', []))
-        return set()
+                completed.update(map(str.strip, f))
+            completed.discard('')
+        return frozenset(completed)
 
-    def save_progress(self, completed: set):
-        """Save download progress."""
+    def save_progress(self, uids):
+        """Append newly downloaded series UIDs to the progress journal."""
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        with open(self.progress_file, 'w') as f:
-            json.dump({
-                'completed': list(completed),
-                'last_updated': datetime.now().isoformat()
-            }, f)
-
-    def download(self, series_df: pd.DataFrame, resume: bool = True,
-                 dry_run: bool = False) -> dict:
+        with open(self.progress_file, 'a') as f:
+            f.write('\n'.join(uids) + '\n')
+
+    def _series_dirs(self, uids: list) -> dict:
+        """Map series UIDs to the directories dir_template downloads them to."""
+        index = self.client.index
+        rows = index.loc[index['SeriesInstanceUID'].isin(uids), list(TEMPLATE_ATTRIBUTES)]
+        series_dirs = {}
+        for row in rows.itertuples(index=False):
+            path = self.dir_template
+            for attr in TEMPLATE_ATTRIBUTES:
+                path = path.replace(f'%{attr}', getattr(row, attr))
+            series_dirs[row.SeriesInstanceUID] = self.output_dir / path
+        return series_dirs
+
+    def _find_invalid_series(self, validator, batch: list) -> list:
+        """Validate a downloaded batch and return the series that must be fetched again.
+
+        Corrupted files are deleted so that the next download replaces them.
+        """
+        index = self.client.index
+        expected_counts = index.loc[index['SeriesInstanceUID'].isin(batch)] \
+            .set_index('SeriesInstanceUID')['instanceCount']
+
+        series_dirs = self._series_dirs(batch)
+        # Series missing from the index have no directory that could be validated
+        invalid = [uid for uid in batch if uid not in series_dirs]
+        for series_uid, series_dir in series_dirs.items():
+            result = validator.validate_series(series_dir)
+            if result['status'] == 'VALID' and result['valid_files'] == expected_counts[series_uid]:
+                continue
+            for corrupted in result.get('corrupted_files', []):
+                (series_dir / corrupted['file']).unlink(missing_ok=True)
+            invalid.append(series_uid)
+        return invalid
+
+    def _create_executor(self):
+        """Create the executor that runs blocking batch downloads.
+
+        idc-index queries DuckDB's default connection, which is not safe to
+        use from several threads at once, so parallel downloads run in worker
+        processes that each hold their own IDCClient. A single worker reuses
+        this downloader's client on a background thread.
+        """
+        if self.max_workers == 1:
+            return ThreadPoolExecutor(max_workers=1)
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+                                   initializer=_init_download_worker)
+
+    async def download(self, series_df: pd.DataFrame, resume: bool = True,
+                       dry_run: bool = False) -> dict:
         """
         Download series in batches with progress tracking.
 
+        Up to ``max_workers`` batches are downloaded concurrently. Batches
+        are started back to back; only a failed batch waits, with exponential
+        backoff, before each of up to ``max_retries`` retries.
+
+        With ``validate`` set, each batch is validated as soon as it has been
+        downloaded, while later batches keep downloading. Series that fail
+        validation are downloaded again, and only validated series are
+        recorded as complete.
+
         Args:
             series_df: DataFrame with SeriesInstanceUID column
             resume: Skip previously downloaded series
@@ -138,22 +232,23 @@ class BatchDownloader:
         Returns:
             dict with download statistics
         """
-        all_uids = set(series_df['SeriesInstanceUID'].values)
+        uids = series_df['SeriesInstanceUID']
 
-        # Filter out already downloaded
-        completed = self.load_progress() if resume else set()
-        remaining = all_uids - completed
-        skipped = len(all_uids) - len(remaining)
+        # Filter out already downloaded and repeated series
+        completed = self.load_progress() if resume else frozenset()
+        first = ~uids.duplicated()
+        done = uids.isin(completed) & first
+        skipped = int(done.sum())
 
         if skipped > 0:
             logger.info(f"Skipping {skipped} previously downloaded series")
 
-        if not remaining:
+        remaining_df = series_df.loc[first & ~done]
+        if remaining_df.empty:
             logger.info("All series already downloaded")
             return {'downloaded': 0, 'skipped': skipped, 'failed': 0}
 
         # Estimate size for remaining
-        remaining_df = series_df[series_df['SeriesInstanceUID'].isin(remaining)]
         size_info = self.estimate_download_size(remaining_df)
 
         logger.info(f"To download: {size_info['series_count']} series ({size_info['total_gb']:.2f} GB)")
@@ -167,38 +262,76 @@ class BatchDownloader:
             raise RuntimeError("Insufficient disk space")
 
         # Download in batches
-        remaining_list = list(remaining)
-        total_batches = (len(remaining_list) + self.batch_size - 1) // self.batch_size
+        remaining_list = remaining_df['SeriesInstanceUID'].tolist()
+        batches = [remaining_list[i:i + self.batch_size]
+                   for i in range(0, len(remaining_list), self.batch_size)]
+        total_batches = len(batches)
         downloaded = 0
         failed = []
 
-        for i in range(0, len(remaining_list), self.batch_size):
-            batch = remaining_list[i:i + self.batch_size]
-            batch_num = i // self.batch_size + 1
-
-            logger.info(f"Batch {batch_num}/{total_batches}: {len(batch)} series")
-
-            try:
-                self.client.download_from_selection(
-                    seriesInstanceUID=batch,
-                    downloadDir=str(self.output_dir),
-                    dirTemplate=self.dir_template
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.BoundedSemaphore(self.max_workers)
+        # Worker processes must create their own client
+        client = self.client if self.max_workers == 1 else None
+
+        async def run_batch(batch_num: int, batch: list, redownloads: int = 0):
+            nonlocal downloaded
+            async with semaphore:
+                logger.info(f"Batch {batch_num}/{total_batches}: {len(batch)} series")
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        await loop.run_in_executor(
+                            executor, _download_batch,
+                            batch, str(self.output_dir), self.dir_template, client
+                        )
+                        break
+                    except Exception as e:
+                        if attempt == self.max_retries:
+                            logger.error(f"Batch {batch_num} failed: {e}")
+                            failed.extend(batch)
+                            return
+                        delay = min(MAX_BACKOFF_SECONDS, 2 ** attempt)
+                        logger.warning(f"Batch {batch_num} failed: {e}. Retrying in {delay}s")
+                        await asyncio.sleep(delay)
+
+            redownload = []
+            if self.validate:
+                # Validation runs on its own thread, overlapping later downloads
+                invalid = await loop.run_in_executor(
+                    validation_executor, self._find_invalid_series, validator, batch
                 )
-
-                # Update progress
-                completed.update(batch)
-                self.save_progress(completed)
+                if invalid:
+                    invalid_set = set(invalid)
+                    batch = [uid for uid in batch if uid not in invalid_set]
+                    if redownloads < self.max_retries:
+                        logger.warning(f"Batch {batch_num}: {len(invalid)} series failed validation, "
+                                       "downloading them again")
+                        redownload = invalid
+                    else:
+                        logger.error(f"Batch {batch_num}: {len(invalid)} series failed validation")
+                        failed.extend(invalid)
+
+            # Update progress
+            if batch:
+                self.save_progress(batch)
                 downloaded += len(batch)
 
-                logger.info(f"Batch {batch_num} complete. Total: {downloaded}/{len(remaining_list)}")
+            logger.info(f"Batch {batch_num} complete. Total: {downloaded}/{len(remaining_list)}")
 
-            except Exception as e:
-                logger.error(f"Batch {batch_num} failed: {e}")
-                failed.extend(batch)
+            if redownload:
+                await run_batch(batch_num, redownload, redownloads + 1)
 
-            # Brief pause between batches
-            if batch_num < total_batches:
-                time.sleep(1)
+        with contextlib.ExitStack() as stack:
+            executor = stack.enter_context(self._create_executor())
+            if self.validate:
+                from validate_download import DicomValidator
+                validator = stack.enter_context(DicomValidator(self.output_dir))
+                validation_executor = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+
+            await asyncio.gather(*(
+                run_batch(batch_num, batch)
+                for batch_num, batch in enumerate(batches, 1)
+            ))
 
         return {
             'downloaded': downloaded,
@@ -230,10 +363,17 @@ def main():
                        help='Directory template for organizing downloads')
 
     # Download options
-    parser.add_argument('--batch-size', type=int, default=20,
-                       help='Number of series per batch (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=BatchDownloader.DEFAULT_BATCH_SIZE,
+                       help='Number of series per batch (default: 100)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of batches to download in parallel (default: 1). '
+                            'Each additional worker loads its own copy of the IDC index')
+    parser.add_argument('--max-retries', type=int, default=3,
+                       help='Retries per failed batch, with exponential backoff (default: 3)')
     parser.add_argument('--no-resume', action='store_true',
                        help='Start fresh, ignore previous progress')
+    parser.add_argument('--validate', action='store_true',
+                       help='Validate each batch once downloaded and re-download invalid series')
     parser.add_argument('--dry-run', action='store_true',
                        help='Show what would be downloaded without downloading')
 
@@ -243,7 +383,10 @@ def main():
     downloader = BatchDownloader(
         output_dir=args.output,
         batch_size=args.batch_size,
-        dir_template=args.dir_template
+        dir_template=args.dir_template,
+        max_workers=args.workers,
+        max_retries=args.max_retries,
+        validate=args.validate
     )
 
     # Get series to download
@@ -255,11 +398,11 @@ def main():
         series_df = downloader.get_series_from_collection(args.collection)
 
     # Download
-    result = downloader.download(
+    result = asyncio.run(downloader.download(
         series_df,
         resume=not args.no_resume,
         dry_run=args.dry_run
-    )
+    ))
 
     # Report
     print("\n--- Download Summary ---")
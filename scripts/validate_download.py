@@ -6,21 +6,33 @@ Usage:
     python validate_download.py --dir ./data
     python validate_download.py --dir ./data --manifest manifest.csv
     python validate_download.py --dir ./data --check-geometry
+    python validate_download.py --dir ./data --check-pixels
 """
 
 import argparse
+import functools
+import io
+import itertools
 import json
 import logging
+import os
+import re
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 try:
+    import numpy as np
     import pydicom
     import pandas as pd
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.pixels import get_decoder
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian
 except ImportError:
     print("Error: Required packages not installed.")
-    print("Install with: pip install pydicom pandas")
+    print("Install with: pip install pydicom pandas numpy")
     sys.exit(1)
 
 
@@ -30,53 +42,208 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-
-class DicomValidator:
-    """Validate downloaded DICOM data integrity and completeness."""
-
-    def __init__(self, download_dir: str):
-        self.download_dir = Path(download_dir)
-        self.results = []
-
-    def find_series_directories(self) -> list:
-        """Find all directories containing DICOM files."""
-        series_dirs = []
-        for path in self.download_dir.rglob('*.dcm'):
-            series_dir = path.parent
-            if series_dir not in series_dirs:
-                series_dirs.append(series_dir)
-        return series_dirs
-
-    def validate_dicom_file(self, filepath: Path) -> dict:
-        """Validate a single DICOM file."""
-        try:
-            ds = pydicom.dcmread(str(filepath))
+# Files handed to each worker process at a time, to amortize IPC overhead
+VALIDATION_CHUNKSIZE = 32
+
+# Allowed variation of the gap between adjacent slice positions
+SLICE_GAP_TOLERANCE_MM = 0.1
+
+# Modalities whose pixel data is decoded when pixel checking is enabled
+IMAGE_MODALITIES = ('CT', 'MR', 'PT', 'CR', 'DX', 'SM')
+
+
+def _serialize_warmup_dataset() -> bytes:
+    """Serialize a tiny dataset with the elements validate_dicom_file reads."""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = '1.2.3.4'
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SpecificCharacterSet = 'ISO_IR 100'
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = '1.2.3.4'
+    ds.SeriesInstanceUID = '1.2.3'
+    ds.Modality = 'CT'
+    ds.Rows = 1
+    ds.Columns = 1
+    ds.PixelSpacing = [1.0, 1.0]
+    ds.ImagePositionPatient = [0.0, 0.0, 0.0]
+    buffer = io.BytesIO()
+    ds.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+# Serialized once, then read by each worker process on startup
+_WARMUP_DICOM = _serialize_warmup_dataset()
+
+
+def _init_worker():
+    """Warm up pydicom's read path in a validation worker process.
+
+    Reading the warm-up file and converting its elements runs the file meta,
+    data dictionary, VR and character set code once before real files arrive.
+    """
+    ds = pydicom.dcmread(io.BytesIO(_WARMUP_DICOM), stop_before_pixels=True)
+    _ = (ds.SeriesInstanceUID, ds.Modality, ds.get('Rows'), ds.get('Columns'),
+         [float(v) for v in ds.PixelSpacing], [float(v) for v in ds.ImagePositionPatient])
+
+
+def _missing_decoder(transfer_syntax) -> str:
+    """Return why pixel data in transfer_syntax cannot be decoded here, or ''."""
+    try:
+        decoder = get_decoder(transfer_syntax)
+    except NotImplementedError:
+        return f"No pixel data decoder for {transfer_syntax}"
+    if not decoder.is_available:
+        return (f"No decoder plugin installed for {transfer_syntax.name}: "
+                + '; '.join(decoder.missing_dependencies))
+    return ''
+
+
+def _float_values(ds, keyword: str, vm: int):
+    """Return a multi-valued element as floats, or None if missing or malformed.
+
+    Geometry is only extracted for check_ct_geometry, so a bad value must
+    never make an otherwise readable file invalid.
+    """
+    try:
+        values = [float(v) for v in ds[keyword].value]
+    except Exception:
+        return None
+    return values if len(values) == vm else None
+
+
+def validate_dicom_file(filepath: str, check_pixels: bool = False) -> dict:
+    """Validate a single DICOM file.
+
+    Only the header is read unless check_pixels is set, in which case the
+    pixel data of image modalities is also decoded.
+    """
+    try:
+        with open(filepath, 'rb') as fp:
+            # Reject truncated and non-DICOM files before parsing: a DICOM
+            # file has a 128-byte preamble followed by the 'DICM' prefix
+            if fp.read(132)[128:] != b'DICM':
+                return {'valid': False, 'error': "Invalid DICOM: missing 'DICM' prefix"}
+            fp.seek(0)
+            ds = pydicom.dcmread(fp, stop_before_pixels=True)
+            # Reading stops at the pixel data element, so any remaining
+            # bytes mean the file has pixel data
             result = {
                 'valid': True,
                 'series_uid': ds.SeriesInstanceUID,
                 'modality': ds.Modality,
-                'has_pixels': hasattr(ds, 'PixelData')
+                'has_pixels': fp.read(1) != b'',
+                # Geometry used by check_ct_geometry
+                'rows': ds.get('Rows'),
+                'cols': ds.get('Columns'),
+                'spacing': _float_values(ds, 'PixelSpacing', 2),
+                'position': _float_values(ds, 'ImagePositionPatient', 3)
             }
 
-            # Try to access pixel array for image modalities
-            if result['has_pixels'] and ds.Modality in ['CT', 'MR', 'PT', 'CR', 'DX', 'SM']:
-                try:
-                    _ = ds.pixel_array
-                    result['pixels_readable'] = True
-                except Exception as e:
+            # Try to decode pixel data for image modalities
+            if check_pixels and result['has_pixels'] and ds.Modality in IMAGE_MODALITIES:
+                missing = _missing_decoder(ds.file_meta.TransferSyntaxUID)
+                if missing:
+                    # Intact files must not be reported corrupted just because
+                    # no decoder plugin (e.g. for JPEG 2000) is installed here
                     result['pixels_readable'] = False
-                    result['pixel_error'] = str(e)
+                    result['pixels_error'] = missing
+                else:
+                    fp.seek(0)
+                    try:
+                        _ = pydicom.dcmread(fp).pixel_array
+                        result['pixels_readable'] = True
+                    except Exception as e:
+                        result['valid'] = False
+                        result['pixels_readable'] = False
+                        result['error'] = f'Unreadable pixel data: {e}'
+
+        return result
+
+    except pydicom.errors.InvalidDicomError as e:
+        return {'valid': False, 'error': f'Invalid DICOM: {e}'}
+    except Exception as e:
+        return {'valid': False, 'error': str(e)}
+
+
+def _stack_vectors(values: list, length: int):
+    """Stack the values of the given length into an array.
+
+    Missing values are skipped. Returns the array and the number of values
+    that had another length.
+    """
+    present = [v for v in values if v]
+    vectors = [v for v in present if len(v) == length]
+    return np.array(vectors, dtype=float).reshape(-1, length), len(present) - len(vectors)
+
+
+def _iter_dicom_dirs(root):
+    """Yield (directory, .dcm file names) for each directory under root with DICOM files.
+
+    Walks the tree with os.walk (backed by os.scandir) and matches file names
+    as plain strings, without building a Path for every file.
+    """
+    for dirpath, _, filenames in os.walk(root):
+        dcm_names = [name for name in filenames if name.endswith('.dcm')]
+        if dcm_names:
+            yield dirpath, dcm_names
+
+
+class DicomValidator:
+    """Validate downloaded DICOM data integrity and completeness.
+
+    Files are validated in a pool of worker processes that is started on
+    first use and kept until close() is called, so it can also serve as a
+    context manager.
+    """
+
+    def __init__(self, download_dir: str, max_workers: int = None,
+                 check_pixels: bool = False):
+        # Keep Path arguments as given instead of copying them
+        self.download_dir = download_dir if isinstance(download_dir, Path) else Path(download_dir)
+        self.max_workers = max_workers
+        self.check_pixels = check_pixels
+        self.results = []
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
-            return result
+    def close(self):
+        """Shut down the validation worker pool."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
-        except pydicom.errors.InvalidDicomError as e:
-            return {'valid': False, 'error': f'Invalid DICOM: {e}'}
-        except Exception as e:
-            return {'valid': False, 'error': str(e)}
+    def find_series_directories(self) -> list:
+        """Find all directories containing DICOM files."""
+        return [Path(dirpath) for dirpath, _ in _iter_dicom_dirs(self.download_dir)]
+
+    def _pool(self) -> ProcessPoolExecutor:
+        """Return the worker pool, starting it on first use."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 initializer=_init_worker)
+        return self._executor
+
+    def validate_files(self, dcm_files: list) -> list:
+        """Validate DICOM files in parallel, returning results in input order."""
+        validate = functools.partial(validate_dicom_file, check_pixels=self.check_pixels)
+        return list(self._pool().map(validate, dcm_files, chunksize=VALIDATION_CHUNKSIZE))
 
     def validate_series(self, series_dir: Path, check_geometry: bool = False) -> dict:
         """Validate all DICOM files in a series directory."""
-        dcm_files = list(series_dir.glob('*.dcm'))
+        # One scandir pass collects str paths without building a Path per file
+        try:
+            with os.scandir(series_dir) as entries:
+                dcm_files = [entry.path for entry in entries
+                             if entry.name.endswith('.dcm') and entry.is_file()]
+        except FileNotFoundError:
+            dcm_files = []
 
         if not dcm_files:
             return {
@@ -85,6 +252,15 @@ class DicomValidator:
                 'error': 'No DICOM files found'
             }
 
+        file_results = self.validate_files(dcm_files)
+        return self._summarize_series(series_dir, dcm_files, file_results, check_geometry)
+
+    def _summarize_series(self, series_dir, dcm_files: list, file_results: list,
+                          check_geometry: bool = False) -> dict:
+        """Build the series result from per-file validation results.
+
+        series_dir and dcm_files may be str or Path objects.
+        """
         result = {
             'directory': str(series_dir),
             'total_files': len(dcm_files),
@@ -94,9 +270,7 @@ class DicomValidator:
             'modality': None
         }
 
-        # Validate each file
-        for f in dcm_files:
-            file_result = self.validate_dicom_file(f)
+        for f, file_result in zip(dcm_files, file_results):
             if file_result['valid']:
                 result['valid_files'] += 1
                 if result['series_uid'] is None:
@@ -104,7 +278,7 @@ class DicomValidator:
                     result['modality'] = file_result.get('modality')
             else:
                 result['corrupted_files'].append({
-                    'file': f.name,
+                    'file': os.path.basename(f),
                     'error': file_result.get('error')
                 })
 
@@ -118,72 +292,131 @@ class DicomValidator:
 
         # Check geometry for CT series
         if check_geometry and result['modality'] == 'CT' and result['status'] == 'VALID':
-            geometry = self.check_ct_geometry(series_dir)
+            geometry = self.check_ct_geometry(file_results)
             result['geometry'] = geometry
             if not geometry['valid']:
                 result['status'] = 'GEOMETRY_ISSUE'
 
         return result
 
-    def check_ct_geometry(self, series_dir: Path) -> dict:
-        """Check CT series geometry consistency."""
-        dcm_files = sorted(series_dir.glob('*.dcm'))
+    def check_ct_geometry(self, slices: list) -> dict:
+        """Check CT series geometry consistency.
 
-        if len(dcm_files) < 2:
+        Args:
+            slices: Per-file validation results carrying rows, cols,
+                spacing and position of each slice
+        """
+        if len(slices) < 2:
             return {'valid': True, 'note': 'Single slice series'}
 
-        slices = []
-        for f in dcm_files:
-            try:
-                ds = pydicom.dcmread(str(f))
-                slices.append({
-                    'rows': ds.Rows,
-                    'cols': ds.Columns,
-                    'spacing': list(ds.PixelSpacing) if hasattr(ds, 'PixelSpacing') else None,
-                    'position': list(ds.ImagePositionPatient) if hasattr(ds, 'ImagePositionPatient') else None
-                })
-            except Exception:
-                continue
-
         issues = []
 
         # Check consistent dimensions
-        rows = set(s['rows'] for s in slices if s['rows'])
-        cols = set(s['cols'] for s in slices if s['cols'])
-        if len(rows) > 1:
-            issues.append(f"Inconsistent rows: {rows}")
-        if len(cols) > 1:
-            issues.append(f"Inconsistent columns: {cols}")
+        rows = np.array([s['rows'] for s in slices if s['rows']], dtype=np.int64)
+        cols = np.array([s['cols'] for s in slices if s['cols']], dtype=np.int64)
+        if rows.size and rows.min() != rows.max():
+            issues.append(f"Inconsistent rows: {np.unique(rows).tolist()}")
+        if cols.size and cols.min() != cols.max():
+            issues.append(f"Inconsistent columns: {np.unique(cols).tolist()}")
 
         # Check consistent spacing
-        spacings = set(tuple(s['spacing']) for s in slices if s['spacing'])
-        if len(spacings) > 1:
-            issues.append(f"Inconsistent pixel spacing")
+        spacings, malformed = _stack_vectors([s['spacing'] for s in slices], 2)
+        if malformed:
+            issues.append(f"Malformed pixel spacing in {malformed} slices")
+        if spacings.size and not np.allclose(spacings, spacings[0]):
+            issues.append("Inconsistent pixel spacing")
+
+        # Check uniform gaps between slices (missing or duplicate slices)
+        positions, malformed = _stack_vectors([s['position'] for s in slices], 3)
+        if malformed:
+            issues.append(f"Malformed image position in {malformed} slices")
+        if len(positions) == len(slices) and len(positions) > 2:
+            # Order slices along the axis they are stacked on
+            axis = np.ptp(positions, axis=0).argmax()
+            gaps = np.diff(np.sort(positions[:, axis]))
+            if np.ptp(gaps) > SLICE_GAP_TOLERANCE_MM:
+                issues.append(
+                    f"Non-uniform slice gaps: {gaps.min():.2f}-{gaps.max():.2f} mm"
+                )
 
         return {
             'valid': len(issues) == 0,
             'num_slices': len(slices),
-            'dimensions': (list(rows)[0] if rows else None, list(cols)[0] if cols else None),
+            'dimensions': (int(rows[0]) if rows.size else None,
+                           int(cols[0]) if cols.size else None),
             'issues': issues
         }
 
-    def validate_against_manifest(self, manifest_path: str) -> list:
-        """Validate downloads against a manifest file."""
+    def _build_series_index(self):
+        """Validate every file on disk and group the results by series.
+
+        Files are grouped by directory and by the SeriesInstanceUID their
+        validation returned, so a directory holding several series (a
+        directory template without %SeriesInstanceUID) is split by series.
+        Unreadable files are assigned to their directory's series when it
+        holds only one.
+
+        Returns:
+            A dict mapping each SeriesInstanceUID to its (directory, files,
+            file results), and a list of the same triples for unreadable
+            files that could not be assigned to a series
+        """
+        dirs = list(_iter_dicom_dirs(self.download_dir))
+        paths = [os.path.join(dirpath, name) for dirpath, names in dirs for name in names]
+        logger.info(f"Validating {len(paths)} files")
+        file_results = iter(self.validate_files(paths))
+
+        series_index = {}
+        unassigned = []
+        for dirpath, names in dirs:
+            # Unreadable files carry no series_uid and are grouped under None
+            groups = {}
+            for name, file_result in zip(names, itertools.islice(file_results, len(names))):
+                files, results = groups.setdefault(file_result.get('series_uid'), ([], []))
+                files.append(os.path.join(dirpath, name))
+                results.append(file_result)
+
+            unreadable = groups.pop(None, None)
+            if unreadable and len(groups) == 1:
+                files, results = next(iter(groups.values()))
+                files.extend(unreadable[0])
+                results.extend(unreadable[1])
+            elif unreadable:
+                unassigned.append((dirpath, *unreadable))
+            for series_uid, (files, results) in groups.items():
+                series_index.setdefault(series_uid, (dirpath, files, results))
+        return series_index, unassigned
+
+    def validate_against_manifest(self, manifest_path: str, check_geometry: bool = False) -> list:
+        """Validate downloads against a manifest file.
+
+        Unreadable files that cannot be matched to a manifest row are
+        reported as extra CORRUPTED results without a series_uid.
+        """
         manifest = pd.read_csv(manifest_path)
 
         if 'SeriesInstanceUID' not in manifest.columns:
             raise ValueError("Manifest must contain SeriesInstanceUID column")
 
-        results = []
-        for _, row in manifest.iterrows():
-            series_uid = row['SeriesInstanceUID']
-            expected_count = row.get('instanceCount', None)
+        series_index, unassigned = self._build_series_index()
 
-            # Find series directory
-            matches = list(self.download_dir.rglob(f"*{series_uid[-12:]}*"))
-            series_dirs = [m for m in matches if m.is_dir() and list(m.glob('*.dcm'))]
+        # A directory with no readable file can still be matched by the
+        # SeriesInstanceUID in its path (see --dir-template)
+        for entry in unassigned[:]:
+            uids = set(re.findall(r'\d+(?:\.\d+)+', entry[0])) - series_index.keys()
+            matches = uids.intersection(manifest['SeriesInstanceUID'])
+            if len(matches) == 1:
+                series_index[matches.pop()] = entry
+                unassigned.remove(entry)
 
-            if not series_dirs:
+        if 'instanceCount' in manifest.columns:
+            expected_counts = [None if pd.isna(c) else c for c in manifest['instanceCount'].tolist()]
+        else:
+            expected_counts = [None] * len(manifest)
+
+        results = []
+        for series_uid, expected_count in zip(manifest['SeriesInstanceUID'], expected_counts):
+            if series_uid not in series_index:
                 results.append({
                     'series_uid': series_uid,
                     'status': 'NOT_FOUND',
@@ -191,34 +424,51 @@ class DicomValidator:
                 })
                 continue
 
-            # Validate the series
-            validation = self.validate_series(series_dirs[0])
+            validation = self._summarize_series(*series_index[series_uid], check_geometry)
             validation['series_uid'] = series_uid
             validation['expected_count'] = expected_count
 
-            if expected_count and validation['valid_files'] != expected_count:
+            if (expected_count and validation['status'] != 'CORRUPTED'
+                    and validation['valid_files'] != expected_count):
                 validation['status'] = 'INCOMPLETE'
                 validation['missing'] = expected_count - validation['valid_files']
 
             results.append(validation)
 
+        results.extend(self._summarize_series(*entry) for entry in unassigned)
         return results
 
+    def _validate_series_files(self, series: list, check_geometry: bool = False) -> list:
+        """Validate (directory, files) pairs with a single pass over the process pool."""
+        dcm_files = [f for _, files in series for f in files]
+        logger.info(f"Validating {len(dcm_files)} files")
+        file_results = iter(self.validate_files(dcm_files))
+
+        # Results come back in file order, so consume them series by series
+        return [
+            self._summarize_series(series_dir, files,
+                                   list(itertools.islice(file_results, len(files))),
+                                   check_geometry)
+            for series_dir, files in series
+        ]
+
     def validate_all(self, check_geometry: bool = False) -> list:
         """Validate all series in download directory."""
-        series_dirs = self.find_series_directories()
-        logger.info(f"Found {len(series_dirs)} series directories")
+        # Paths stay plain strings; pydicom opens them directly
+        series = [
+            (dirpath, [os.path.join(dirpath, name) for name in dcm_names])
+            for dirpath, dcm_names in _iter_dicom_dirs(self.download_dir)
+        ]
+        logger.info(f"Found {len(series)} series directories")
 
-        results = []
-        for i, series_dir in enumerate(series_dirs, 1):
-            logger.info(f"Validating {i}/{len(series_dirs)}: {series_dir.name}")
-            result = self.validate_series(series_dir, check_geometry)
-            results.append(result)
-
-        return results
+        return self._validate_series_files(series, check_geometry)
 
     def generate_report(self, results: list) -> dict:
         """Generate summary report from validation results."""
+        status_counts = Counter(r.get('status', 'UNKNOWN').lower() for r in results)
+        # GEOMETRY_ISSUE is counted under the plural summary key
+        status_counts['geometry_issues'] = status_counts.pop('geometry_issue', 0)
+
         summary = {
             'total_series': len(results),
             'valid': 0,
@@ -227,15 +477,10 @@ class DicomValidator:
             'not_found': 0,
             'incomplete': 0,
             'geometry_issues': 0,
-            'total_files': 0,
-            'valid_files': 0
+            'total_files': sum(r.get('total_files', 0) for r in results),
+            'valid_files': sum(r.get('valid_files', 0) for r in results)
         }
-
-        for r in results:
-            status = r.get('status', 'UNKNOWN')
-            summary[status.lower()] = summary.get(status.lower(), 0) + 1
-            summary['total_files'] += r.get('total_files', 0)
-            summary['valid_files'] += r.get('valid_files', 0)
+        summary.update(status_counts)
 
         summary['validation_rate'] = (
             f"{summary['valid_files']}/{summary['total_files']}"
@@ -256,20 +501,24 @@ def main():
                        help='CSV manifest to validate against')
     parser.add_argument('--check-geometry', action='store_true',
                        help='Check CT series geometry consistency')
+    parser.add_argument('--check-pixels', action='store_true',
+                       help='Decode pixel data of image series (slower)')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Number of validation worker processes (default: CPU count)')
     parser.add_argument('--output', '-o', type=str,
                        help='Output file for detailed JSON report')
 
     args = parser.parse_args()
 
-    validator = DicomValidator(args.dir)
-
-    # Run validation
-    if args.manifest:
-        logger.info(f"Validating against manifest: {args.manifest}")
-        results = validator.validate_against_manifest(args.manifest)
-    else:
-        logger.info(f"Validating all series in: {args.dir}")
-        results = validator.validate_all(args.check_geometry)
+    with DicomValidator(args.dir, max_workers=args.workers,
+                        check_pixels=args.check_pixels) as validator:
+        # Run validation
+        if args.manifest:
+            logger.info(f"Validating against manifest: {args.manifest}")
+            results = validator.validate_against_manifest(args.manifest, args.check_geometry)
+        else:
+            logger.info(f"Validating all series in: {args.dir}")
+            results = validator.validate_all(args.check_geometry)
 
     # Generate report
     summary = validator.generate_report(results)
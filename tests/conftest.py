@@ -2,18 +2,65 @@
 Pytest configuration and fixtures for IDC skill tests.
 """
 
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
 import pytest
+from idc_index import IDCClient
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+
+# Make the scripts importable once, at collection time. idc-index, pydicom and
+# pandas are hard requirements of the suite: nothing is skipped without them
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+from validate_download import DicomValidator  # noqa: E402
+from batch_download import BatchDownloader  # noqa: E402
+
+
+def pytest_configure(config):
+    """Place temporary directories on tmpfs when available (Linux).
+
+    Only the root changes, so pytest keeps its numbered, locked session
+    directories and tmp_path_retention_count still applies.
+    """
+    if os.path.isdir("/dev/shm"):
+        os.environ.setdefault("PYTEST_DEBUG_TEMPROOT", "/dev/shm")
 
 
 @pytest.fixture(scope="session")
 def idc_client():
     """Create IDC client for session-scoped tests."""
-    try:
-        from idc_index import IDCClient
-        client = IDCClient()
-        yield client
-    except ImportError:
-        pytest.skip("idc-index not installed")
+    return IDCClient()
+
+
+@pytest.fixture(scope="module")
+def shared_tmpdir(tmp_path_factory):
+    """Temporary directory shared by the tests of a module."""
+    return tmp_path_factory.mktemp("dicom")
+
+
+@pytest.fixture(scope="module")
+def validator(shared_tmpdir):
+    """DicomValidator over the shared directory, for tests that do not modify it."""
+    with DicomValidator(shared_tmpdir) as validator:
+        yield validator
+
+
+@pytest.fixture(scope="module")
+def downloader(shared_tmpdir):
+    """BatchDownloader over the shared directory, for tests that do not modify it."""
+    return BatchDownloader(shared_tmpdir)
+
+
+@pytest.fixture
+def fresh_downloader(tmp_path):
+    """BatchDownloader over its own directory, for tests that record progress."""
+    return BatchDownloader(tmp_path)
 
 
 @pytest.fixture
@@ -54,3 +101,41 @@ def expected_index_columns():
         'instanceCount',
         'license_short_name'
     ]
+
+
+@pytest.fixture
+def write_ct_series():
+    """Return a function writing a small synthetic CT series to a directory."""
+    def write(series_dir, series_uid=None, num_slices=3, prefix="slice"):
+        series_dir.mkdir(parents=True, exist_ok=True)
+        series_uid = series_uid or generate_uid()
+        for i in range(num_slices):
+            ds = Dataset()
+            ds.file_meta = FileMetaDataset()
+            ds.file_meta.MediaStorageSOPClassUID = CTImageStorage
+            ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds.SOPClassUID = CTImageStorage
+            ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+            ds.SeriesInstanceUID = series_uid
+            ds.Modality = 'CT'
+            ds.Rows = 4
+            ds.Columns = 4
+            ds.PixelSpacing = [0.5, 0.5]
+            ds.ImagePositionPatient = [0.0, 0.0, 2.5 * i]
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.BitsAllocated = 16
+            ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 0
+            ds.PixelData = np.zeros((4, 4), dtype=np.uint16).tobytes()
+            ds.save_as(series_dir / f"{prefix}_{i:03d}.dcm", enforce_file_format=True)
+        return series_dir
+    return write
+
+
+@pytest.fixture
+def ct_series_dir(tmp_path, write_ct_series):
+    """Write a small synthetic CT series and return its directory."""
+    return write_ct_series(tmp_path / "CT_series")
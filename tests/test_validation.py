@@ -4,161 +4,463 @@ Tests for DICOM validation utilities.
 Run with: pytest tests/test_validation.py -v
 """
 
-import pytest
-import tempfile
-from pathlib import Path
-import sys
-
-# Add scripts directory to path
-scripts_dir = Path(__file__).parent.parent / "scripts"
-sys.path.insert(0, str(scripts_dir))
-
-
-class TestValidatorImport:
-    """Test that validation module can be imported."""
-
-    def test_import_validator(self):
-        """Test importing the validator module."""
-        try:
-            from validate_download import DicomValidator
-            assert DicomValidator is not None
-        except ImportError as e:
-            pytest.skip(f"Could not import validator: {e}")
-
-
-class TestValidatorInitialization:
-    """Test validator initialization."""
-
-    def test_validator_with_temp_dir(self):
-        """Test creating validator with temporary directory."""
-        from validate_download import DicomValidator
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            validator = DicomValidator(tmpdir)
-            assert validator.download_dir == Path(tmpdir)
-
-    def test_find_empty_directory(self):
-        """Test finding series in empty directory."""
-        from validate_download import DicomValidator
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            validator = DicomValidator(tmpdir)
-            series_dirs = validator.find_series_directories()
-            assert series_dirs == []
-
-
-class TestValidationResults:
-    """Test validation result handling."""
-
-    def test_generate_report_empty(self):
-        """Test generating report with empty results."""
-        from validate_download import DicomValidator
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            validator = DicomValidator(tmpdir)
-            report = validator.generate_report([])
-            assert report['total_series'] == 0
-            assert report['valid'] == 0
-
-    def test_generate_report_with_results(self):
-        """Test generating report with mock results."""
-        from validate_download import DicomValidator
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            validator = DicomValidator(tmpdir)
-
-            mock_results = [
-                {'status': 'VALID', 'total_files': 100, 'valid_files': 100},
-                {'status': 'VALID', 'total_files': 50, 'valid_files': 50},
-                {'status': 'CORRUPTED', 'total_files': 10, 'valid_files': 0},
-            ]
-
-            report = validator.generate_report(mock_results)
-            assert report['total_series'] == 3
-            assert report['valid'] == 2
-            assert report['corrupted'] == 1
-            assert report['total_files'] == 160
-            assert report['valid_files'] == 150
-
-
-class TestBatchDownloaderImport:
-    """Test that batch downloader module can be imported."""
-
-    def test_import_batch_downloader(self):
-        """Test importing the batch downloader module."""
-        try:
-            from batch_download import BatchDownloader
-            assert BatchDownloader is not None
-        except ImportError as e:
-            pytest.skip(f"Could not import batch downloader: {e}")
-
-
-class TestBatchDownloaderInitialization:
-    """Test batch downloader initialization."""
-
-    def test_downloader_with_temp_dir(self):
-        """Test creating downloader with temporary directory."""
-        from batch_download import BatchDownloader
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir)
-            assert downloader.output_dir == Path(tmpdir)
-            assert downloader.batch_size == 20  # default
-
-    def test_downloader_custom_batch_size(self):
-        """Test creating downloader with custom batch size."""
-        from batch_download import BatchDownloader
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir, batch_size=50)
-            assert downloader.batch_size == 50
-
-
-class TestProgressTracking:
-    """Test download progress tracking."""
-
-    def test_save_and_load_progress(self):
-        """Test saving and loading download progress."""
-        from batch_download import BatchDownloader
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir)
-
-            # Save progress
-            test_uids = {'uid1', 'uid2', 'uid3'}
-            downloader.save_progress(test_uids)
-
-            # Load progress
-            loaded = downloader.load_progress()
-            assert loaded == test_uids
-
-    def test_empty_progress(self):
-        """Test loading progress when no file exists."""
-        from batch_download import BatchDownloader
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir)
-            progress = downloader.load_progress()
-            assert progress == set()
+import asyncio
+from collections import namedtuple
+from unittest import mock
 
+import pandas as pd
+import pydicom
+import pytest
+from pydicom.encaps import encapsulate
+from pydicom.uid import JPEG2000Lossless
 
-class TestDiskSpaceCheck:
-    """Test disk space checking functionality."""
+from batch_download import BatchDownloader
+from validate_download import _WARMUP_DICOM, DicomValidator, validate_dicom_file
 
-    def test_check_disk_space_small_requirement(self):
-        """Test disk space check with small requirement."""
-        from batch_download import BatchDownloader
+# Series results for report tests; generate_report does not modify them
+_MOCK_RESULTS = [
+    {'status': 'VALID', 'total_files': 100, 'valid_files': 100},
+    {'status': 'VALID', 'total_files': 50, 'valid_files': 50},
+    {'status': 'CORRUPTED', 'total_files': 10, 'valid_files': 0},
+]
+
+# Series UIDs for progress round-trip tests
+_EXPECTED_UIDS = frozenset({'uid1', 'uid2', 'uid3'})
+
+# Fixed shutil.disk_usage result: 1 TB total, 500 GB free
+_DISK_USAGE = namedtuple('usage', 'total used free')(10**12, 5 * 10**11, 5 * 10**11)
+
+
+# Validator initialization
+
+@pytest.mark.validator
+@pytest.mark.smoke
+def test_validator_with_temp_dir(validator, shared_tmpdir):
+    """Test creating validator with temporary directory."""
+    assert validator.download_dir is shared_tmpdir
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir)
-            # 1 MB should always be available
-            assert downloader.check_disk_space(1) is True
 
-    def test_check_disk_space_huge_requirement(self):
-        """Test disk space check with unrealistic requirement."""
-        from batch_download import BatchDownloader
+@pytest.mark.validator
+@pytest.mark.smoke
+def test_validator_init_touches_no_filesystem(shared_tmpdir):
+    """Test that the constructor leaves the download directory alone."""
+    with mock.patch('os.stat') as stat, mock.patch('os.mkdir') as mkdir:
+        DicomValidator(shared_tmpdir)
+    stat.assert_not_called()
+    mkdir.assert_not_called()
+
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            downloader = BatchDownloader(tmpdir)
-            # 1 PB should not be available
-            assert downloader.check_disk_space(1024 * 1024 * 1024 * 1024) is False
+@pytest.mark.validator
+@pytest.mark.smoke
+def test_find_empty_directory(validator):
+    """Test finding series in empty directory."""
+    series_dirs = validator.find_series_directories()
+    assert series_dirs == []
+
+
+# Single-file DICOM validation
+
+@pytest.mark.validator
+def test_header_only_by_default(ct_series_dir):
+    """Test that files validate without decoding pixel data."""
+    result = validate_dicom_file(next(ct_series_dir.glob('*.dcm')))
+    assert result['valid'] is True
+    assert result['modality'] == 'CT'
+    assert result['has_pixels'] is True
+    assert 'pixels_readable' not in result
+
+
+@pytest.mark.validator
+@pytest.mark.parametrize("pixel_spacing", [None, 0.5, [0.5, 0.5, 0.5]])
+def test_malformed_geometry_keeps_file_valid(ct_series_dir, pixel_spacing):
+    """Test that an empty or wrong-VM PixelSpacing only drops the spacing."""
+    dcm_file = next(ct_series_dir.glob('*.dcm'))
+    ds = pydicom.dcmread(dcm_file)
+    ds.PixelSpacing = pixel_spacing
+    ds.save_as(dcm_file, enforce_file_format=True)
+
+    result = validate_dicom_file(dcm_file)
+    assert result['valid'] is True
+    assert result['spacing'] is None
+    assert len(result['position']) == 3
+
+
+@pytest.mark.validator
+def test_rejects_file_without_dicm_prefix(tmp_path):
+    """Test that non-DICOM files are rejected without parsing."""
+    partial = tmp_path / "partial.dcm"
+    partial.write_bytes(b'\0' * 64)
+
+    result = validate_dicom_file(partial)
+    assert result['valid'] is False
+    assert 'DICM' in result['error']
+
+
+@pytest.mark.validator
+def test_check_pixels_detects_truncated_pixel_data(ct_series_dir):
+    """Test that truncated pixel data fails only when pixels are checked."""
+    dcm_file = next(ct_series_dir.glob('*.dcm'))
+    dcm_file.write_bytes(dcm_file.read_bytes()[:-8])
+
+    assert validate_dicom_file(dcm_file)['valid'] is True
+    result = validate_dicom_file(dcm_file, check_pixels=True)
+    assert result['valid'] is False
+    assert result['pixels_readable'] is False
+
+
+@pytest.mark.validator
+def test_check_pixels_without_decoder_keeps_file_valid(ct_series_dir):
+    """Test that a missing decoder plugin is not reported as corruption."""
+    dcm_file = next(ct_series_dir.glob('*.dcm'))
+    ds = pydicom.dcmread(dcm_file)
+    ds.file_meta.TransferSyntaxUID = JPEG2000Lossless
+    ds.PixelData = encapsulate([b'\0' * 16])
+    ds.save_as(dcm_file, enforce_file_format=True)
+
+    decoder = mock.Mock(is_available=False, missing_dependencies=['pylibjpeg'])
+    with mock.patch('validate_download.get_decoder', return_value=decoder):
+        result = validate_dicom_file(dcm_file, check_pixels=True)
+    assert result['valid'] is True
+    assert result['pixels_readable'] is False
+    assert 'pylibjpeg' in result['pixels_error']
+
+
+@pytest.mark.validator
+def test_worker_warmup_file_is_valid_dicom(tmp_path):
+    """Test that workers warm up on a real dataset, not an empty one."""
+    warmup = tmp_path / "warmup.dcm"
+    warmup.write_bytes(_WARMUP_DICOM)
+
+    result = validate_dicom_file(warmup)
+    assert result['valid'] is True
+    assert result['modality'] == 'CT'
+    assert result['spacing'] == [1.0, 1.0]
+
+
+# CT geometry consistency checks
+
+@pytest.mark.validator
+def test_consistent_series(ct_series_dir):
+    """Test geometry check on a consistent series."""
+    with DicomValidator(ct_series_dir.parent) as validator:
+        result = validator.validate_series(ct_series_dir, check_geometry=True)
+    assert result['status'] == 'VALID'
+    assert result['geometry']['valid'] is True
+    assert result['geometry']['num_slices'] == 3
+    assert result['geometry']['dimensions'] == (4, 4)
+
+
+@pytest.mark.validator
+def test_inconsistent_rows(validator):
+    """Test geometry check reports slices with differing rows."""
+    slices = [
+        {'rows': 512, 'cols': 512, 'spacing': [0.7, 0.7], 'position': [0, 0, 0]},
+        {'rows': 256, 'cols': 512, 'spacing': [0.7, 0.7], 'position': [0, 0, 1]},
+    ]
+    geometry = validator.check_ct_geometry(slices)
+    assert geometry['valid'] is False
+    assert any('rows' in issue for issue in geometry['issues'])
+
+
+@pytest.mark.validator
+def test_missing_slice(validator):
+    """Test geometry check reports a gap left by a missing slice."""
+    slices = [
+        {'rows': 512, 'cols': 512, 'spacing': [0.7, 0.7], 'position': [0, 0, z]}
+        for z in (0.0, 2.5, 7.5, 10.0)
+    ]
+    geometry = validator.check_ct_geometry(slices)
+    assert geometry['valid'] is False
+    assert any('slice gaps' in issue for issue in geometry['issues'])
+
+
+@pytest.mark.validator
+def test_malformed_spacing_is_a_geometry_issue(validator):
+    """Test geometry check reports, rather than fails on, spacing of the wrong length."""
+    slices = [
+        {'rows': 512, 'cols': 512, 'spacing': spacing, 'position': [0, 0, z]}
+        for spacing, z in (([0.5, 0.5], 0.0), ([0.5], 1.0), ([0.5, 0.5], 2.0))
+    ]
+    geometry = validator.check_ct_geometry(slices)
+    assert geometry['valid'] is False
+    assert geometry['issues'] == ["Malformed pixel spacing in 1 slices"]
+
+
+# Validation against a manifest
+
+@pytest.mark.validator
+def test_found_and_missing_series(ct_series_dir):
+    """Test manifest rows are matched to series directories by UID."""
+    series_uid = pydicom.dcmread(next(ct_series_dir.glob('*.dcm'))).SeriesInstanceUID
+    manifest = ct_series_dir.parent / "manifest.csv"
+    manifest.write_text(
+        "SeriesInstanceUID,instanceCount\n"
+        f"{series_uid},3\n"
+        "1.2.3.4,10\n"
+    )
+
+    with DicomValidator(ct_series_dir.parent) as validator:
+        results = validator.validate_against_manifest(str(manifest))
+    assert [r['status'] for r in results] == ['VALID', 'NOT_FOUND']
+    assert results[0]['directory'] == str(ct_series_dir)
+
+
+@pytest.mark.validator
+def test_manifest_series_sharing_a_directory(tmp_path, write_ct_series):
+    """Test that series downloaded into one directory are matched separately."""
+    study_dir = tmp_path / "study"
+    write_ct_series(study_dir, '1.2.3.1', num_slices=3, prefix="a")
+    write_ct_series(study_dir, '1.2.3.2', num_slices=2, prefix="b")
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "SeriesInstanceUID,instanceCount\n"
+        "1.2.3.1,3\n"
+        "1.2.3.2,2\n"
+    )
+
+    with DicomValidator(tmp_path) as validator:
+        results = validator.validate_against_manifest(str(manifest))
+    assert [r['status'] for r in results] == ['VALID', 'VALID']
+    assert [r['total_files'] for r in results] == [3, 2]
+
+
+@pytest.mark.validator
+def test_manifest_series_with_only_corrupted_files(tmp_path):
+    """Test a series directory with no readable file is CORRUPTED, not NOT_FOUND."""
+    series_dir = tmp_path / "CT_1.2.9"
+    series_dir.mkdir()
+    (series_dir / "x.dcm").write_bytes(b"\0" * 64)
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("SeriesInstanceUID,instanceCount\n1.2.9,1\n")
+
+    with DicomValidator(tmp_path) as validator:
+        results = validator.validate_against_manifest(str(manifest))
+    assert [r['status'] for r in results] == ['CORRUPTED']
+    assert results[0]['series_uid'] == '1.2.9'
+
+
+@pytest.mark.validator
+def test_manifest_reports_unassigned_corrupted_files(tmp_path, write_ct_series):
+    """Test unreadable files in a directory holding several series are reported."""
+    study_dir = tmp_path / "study"
+    write_ct_series(study_dir, '1.2.3.1', num_slices=2, prefix="a")
+    write_ct_series(study_dir, '1.2.3.2', num_slices=2, prefix="b")
+    (study_dir / "bad.dcm").write_bytes(b"\0" * 64)
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text(
+        "SeriesInstanceUID,instanceCount\n"
+        "1.2.3.1,2\n"
+        "1.2.3.2,2\n"
+    )
+
+    with DicomValidator(tmp_path) as validator:
+        results = validator.validate_against_manifest(str(manifest))
+    assert [r['status'] for r in results] == ['VALID', 'VALID', 'CORRUPTED']
+    assert results[2]['series_uid'] is None
+    assert [f['file'] for f in results[2]['corrupted_files']] == ['bad.dcm']
+
+
+# Validation result handling
+
+@pytest.mark.validator
+def test_generate_report_empty(validator):
+    """Test generating report with empty results."""
+    report = validator.generate_report([])
+    assert report['total_series'] == 0
+    assert report['valid'] == 0
+
+
+@pytest.mark.validator
+def test_generate_report_with_results(validator):
+    """Test generating report with mock results."""
+    report = validator.generate_report(_MOCK_RESULTS)
+    expected = {'total_series': 3, 'valid': 2, 'corrupted': 1,
+                'total_files': 160, 'valid_files': 150}
+    assert expected.items() <= report.items()
+
+
+@pytest.mark.validator
+def test_generate_report_scales(validator):
+    """Test that report generation reads each result a bounded number of times."""
+    class CountingResult(dict):
+        reads = 0
+
+        def get(self, *args):
+            CountingResult.reads += 1
+            return super().get(*args)
+
+        def __getitem__(self, key):
+            CountingResult.reads += 1
+            return super().__getitem__(key)
+
+    result = CountingResult(status='VALID', total_files=10, valid_files=10)
+    report = validator.generate_report([result] * 10_000)
+    assert report['valid'] == 10_000
+    # A per-series scan of all results would read them about 10k times each
+    assert CountingResult.reads <= 5 * 10_000
+
+
+@pytest.mark.validator
+def test_generate_report_counts_geometry_issues(validator):
+    """Test that GEOMETRY_ISSUE results are counted as geometry_issues."""
+    report = validator.generate_report([
+        {'status': 'GEOMETRY_ISSUE', 'total_files': 10, 'valid_files': 10},
+    ])
+    assert report['geometry_issues'] == 1
+    assert 'geometry_issue' not in report
+
+
+# Batch downloader initialization
+
+@pytest.mark.downloader
+@pytest.mark.smoke
+@pytest.mark.parametrize("kwargs,expected_batch_size", [
+    ({}, BatchDownloader.DEFAULT_BATCH_SIZE),
+    ({'batch_size': None}, BatchDownloader.DEFAULT_BATCH_SIZE),
+    ({'batch_size': 50}, 50),
+])
+def test_downloader_batch_size(shared_tmpdir, kwargs, expected_batch_size):
+    """Test creating downloader with default and custom batch size."""
+    # Keep the smoke run fast: constructing a real IDCClient loads its index
+    with mock.patch('batch_download.IDCClient'):
+        downloader = BatchDownloader(shared_tmpdir, **kwargs)
+    assert downloader.output_dir == shared_tmpdir
+    assert downloader.batch_size == expected_batch_size
+
+
+@pytest.mark.downloader
+@pytest.mark.smoke
+def test_downloader_init_touches_no_filesystem(shared_tmpdir):
+    """Test that the output directory is only created when downloading."""
+    with mock.patch('batch_download.IDCClient'), \
+            mock.patch('os.stat') as stat, mock.patch('os.mkdir') as mkdir:
+        BatchDownloader(shared_tmpdir)
+    stat.assert_not_called()
+    mkdir.assert_not_called()
+
+
+@pytest.mark.downloader
+@pytest.mark.smoke
+def test_validate_requires_series_uid_in_template(tmp_path):
+    """Test that validation needs series directories named by UID."""
+    with pytest.raises(ValueError):
+        BatchDownloader(tmp_path, dir_template="%collection_id/%PatientID", validate=True)
+
+
+# Download progress tracking. Progress files are written to pyfakefs'
+# in-memory filesystem (fs), so the shared downloader, built before fs is
+# set up, stays clean on disk.
+
+@pytest.mark.downloader
+def test_save_and_load_progress(downloader, fs):
+    """Test saving and loading download progress."""
+    downloader.save_progress(_EXPECTED_UIDS)
+    assert downloader.load_progress() == _EXPECTED_UIDS
+
+
+@pytest.mark.downloader
+def test_progress_accumulates_across_saves(downloader, fs):
+    """Test that each save appends to the journal without rewriting it."""
+    for uid in sorted(_EXPECTED_UIDS):
+        downloader.save_progress([uid])
+    downloader.save_progress(['uid1'])
+
+    assert downloader.load_progress() == _EXPECTED_UIDS
+    assert len(downloader.progress_file.read_text().splitlines()) == 4
+
+
+@pytest.mark.downloader
+def test_load_legacy_progress(downloader, fs):
+    """Test resuming from a JSON progress file of earlier versions."""
+    fs.create_file(downloader.legacy_progress_file, contents='{"completed": ["uid1", "uid2"]}')
+    downloader.save_progress(['uid3'])
+
+    assert downloader.load_progress() == {'uid1', 'uid2', 'uid3'}
+
+
+@pytest.mark.downloader
+def test_empty_progress(downloader):
+    """Test loading progress when no file exists."""
+    progress = downloader.load_progress()
+    assert progress == set()
+
+
+# Series selection and batch download retries
+
+@pytest.mark.downloader
+def test_get_series_from_collection(downloader, sample_collection):
+    """Test selecting all series of a collection."""
+    series_df = downloader.get_series_from_collection(sample_collection)
+    assert len(series_df) > 0
+    assert list(series_df.columns) == ['SeriesInstanceUID', 'series_size_MB', 'instanceCount']
+    assert series_df['SeriesInstanceUID'].is_unique
+
+
+@pytest.mark.downloader
+def test_failed_batch_is_retried(fresh_downloader):
+    """Test that a failed batch is retried after a backoff."""
+    fresh_downloader.max_retries = 2
+    series_df = pd.DataFrame({'SeriesInstanceUID': ['uid1'], 'series_size_MB': [1.0]})
+
+    with mock.patch('batch_download._download_batch',
+                    side_effect=[RuntimeError('timeout'), None]) as download_batch, \
+            mock.patch('batch_download.asyncio.sleep') as sleep:
+        result = asyncio.run(fresh_downloader.download(series_df))
+
+    assert download_batch.call_count == 2
+    sleep.assert_awaited_once_with(1)
+    assert result['downloaded'] == 1
+    assert result['failed'] == 0
+    assert fresh_downloader.load_progress() == {'uid1'}
+
+
+@pytest.mark.downloader
+def test_invalid_series_are_downloaded_again(fresh_downloader, write_ct_series):
+    """Test that series failing validation are re-downloaded, then failed."""
+    series_uid = '1.2.826.0.1.3680043.8.498.1'
+    unindexed_uid = '9.9'
+    fresh_downloader.client = mock.Mock(index=pd.DataFrame({
+        'SeriesInstanceUID': [series_uid], 'PatientID': ['P1'], 'collection_id': ['c1'],
+        'Modality': ['CT'], 'StudyInstanceUID': ['1.2.3'], 'instanceCount': [3],
+        'series_size_MB': [1.0],
+    }))
+    fresh_downloader.dir_template = '%SeriesInstanceUID'
+    fresh_downloader.validate = True
+    fresh_downloader.max_retries = 1
+    series_dir = fresh_downloader.output_dir / series_uid
+    calls = []
+
+    def download_batch(batch, download_dir, dir_template, client):
+        calls.append(list(batch))
+        if len(calls) == 1:
+            # First download leaves one slice truncated
+            write_ct_series(series_dir, series_uid)
+            (series_dir / 'slice_002.dcm').write_bytes(b'\0' * 64)
+        else:
+            # The corrupted slice was removed before downloading again
+            assert not (series_dir / 'slice_002.dcm').exists()
+            write_ct_series(series_dir, series_uid)
+
+    series_df = pd.DataFrame({'SeriesInstanceUID': [series_uid, unindexed_uid],
+                              'series_size_MB': [1.0, 1.0]})
+    with mock.patch('batch_download._download_batch', side_effect=download_batch):
+        result = asyncio.run(fresh_downloader.download(series_df))
+
+    assert calls == [[series_uid, unindexed_uid], [unindexed_uid, series_uid]]
+    assert result['downloaded'] == 1
+    assert result['failed'] == 1
+    assert result['failed_uids'] == [unindexed_uid]
+    assert fresh_downloader.load_progress() == {series_uid}
+
+
+# Disk space checking functionality
+
+@pytest.mark.downloader
+@pytest.mark.parametrize("required_mb,expected", [
+    (1, True),  # 1 MB fits in the reported free space
+    (1024 * 1024 * 1024 * 1024, False),  # 1 EB does not
+])
+def test_check_disk_space(downloader, required_mb, expected):
+    """Test disk space check with small and unrealistic requirements."""
+    with mock.patch('batch_download.shutil.disk_usage', return_value=_DISK_USAGE):
+        assert downloader.check_disk_space(required_mb) is expected